@@ -1,185 +1,340 @@
-﻿# --------------------------------------------------------
-# VOXNOT(other name XNOT-VC): 
-# Github source: https://github.com/dmitrii-raketa-erusov/XNOT-VC
-# Copyright (c) 2024 Dmitrii Erusov
-# Licensed under The MIT License [see LICENSE for details]
-# Based on code bases
-# https://github.com/pytorch/
-# --------------------------------------------------------
-# Класс представляющий верхнеуровневое API для задач аудио-конверсии, 
-# а конкретно конверсии голоса в голос
-# на базе алгоритма XNOT(см. статью https://arxiv.org/pdf/2301.12874)
-
-# Предоставляет верхнеуровневые методы тренировки моделей с разными гипер-параметрами
-# и методы использования посчитанных моделей для конвертации речи из входной речи в речь на целевом голосе
-    
-# Основные методы для работы - 
-    
-# train
-# make_conversation
-# --------------------------------------------------------
-
-import gc
-import os
-import shutil
-import torch
-
-from sources.params import VOXNOTModelHyperParams, VOXNOTModelTrainingEnvironment, VOXNOTModelTrainingHyperParams
-from sources.base_model import VOXNOTBaseModel
-from sources.data_preparation import VOXNOTDatasetPreparationTools
-from sources.voxnot_dataset import VOXNOTDataset
-from sources.audio_helper import VOXNOTFeaturesHelper
-from datasets import con
-from torch.utils.data import ConcatDataset
-
-class VOXNOT:
-    """
-    Класс представляющий верхнеуровневое API для задач аудио-конверсии, 
-    а конкретно конверсии голоса в голос
-    на базе алгоритма XNOT(см. статью https://arxiv.org/pdf/2301.12874)
-
-    Предоставляет верхнеуровневые методы тренировки моделей с разными гипер-параметрами
-    и методы использования посчитанных моделей для конвертации речи из входной речи в речь на целевом голосе
-    
-    Основные методы для работы - 
-    
-    train
-    make_conversation
-    """
-    model_instance:VOXNOTBaseModel
-
-    def _clear_folder(dir):
-      if os.path.exists(dir):
-          for the_file in os.listdir(dir):
-              file_path = os.path.join(dir, the_file)
-
-              try:
-                  if os.path.isfile(file_path):
-                      os.remove(file_path)
-                  else:
-                      VOXNOT._clear_folder(file_path)
-                      os.rmdir(file_path)
-
-                  print(f'Clear file {file_path} from dataset directory')
-              except Exception as e:
-                  print(e)
-
-    def __init__(self, device, model_class_name:str, hyper_params:VOXNOTModelHyperParams, prod_mode:bool):
-        """
-        model_class_name - Класс модели для конверсии
-        hyper_params - гипер-параметры модели
-        prod_mode - указывает как будет использоваться модель, для тренировки или конверсии. True - если для конверсии
-        """
-        self.device = device
-        class_object = globals()[model_class_name]
-        self.model_instance = class_object(device, hyper_params, prod_mode)
-
-    def _prepare_dataset(self, delete_last_prepared_data, input_dir, dataset_dir):
-        exists_prepared_datasets = False
-
-        for file_ds in os.listdir(dataset_dir):
-          path_file_ds = os.path.join(dataset_dir, file_ds)
-          if os.path.isfile(path_file_ds) and os.path.splitext(path_file_ds)[1] == '.pt':
-            exists_prepared_datasets = True
-            break
-
-        if delete_last_prepared_data == True or exists_prepared_datasets == False:
-          print(f'Preparing datasets {input_dir}..')
-
-          if os.path.isdir(dataset_dir) == True:
-              VOXNOT._clear_folder(dataset_dir)
-          else:
-            os.mkdir(dataset_dir)
-
-          tool = VOXNOTDatasetPreparationTools(input_dir, dataset_dir, augmentation = None, keep_converted_audio = True, device = self.device, vad_trigger_level=0)
-          tool.prepare()
-
-        VOXNOT.clear_mem()
-
-        datasets = []
-
-        for file_ds in os.listdir(dataset_dir):
-          path_file_ds = os.path.join(dataset_dir, file_ds)
-          if os.path.isfile(path_file_ds) and os.path.splitext(path_file_ds)[1] == '.pt':
-            datasets += [VOXNOTDataset(path_file_ds, self.device)]
-
-        return ConcatDataset(datasets)
-
-    def clear_mem():
-        """
-        Метод для очистки мусора в памяти
-        лучше вызывать между тренировками или вычислениями        
-        """
-        gc.collect()
-        torch.cuda.empty_cache()
-        with torch.no_grad():
-          torch.cuda.empty_cache()
-
-    def train(self, delete_last_prepared_data:bool, input_query_dir:str | os.PathLike, input_reffer_dir:str | os.PathLike,
-              temp_dir:str | os.PathLike, output_dir:str | os.PathLike,
-              training_hyper_params:VOXNOTModelTrainingHyperParams, training_env:VOXNOTModelTrainingEnvironment,
-              training_name:str):
-        """
-        Метод тренировки модели
-        
-        delete_last_prepared_data - если True, то предыдущие тренировочные датасеты сделанные из audio-файлов будут удалены, если False, 
-        то будут использоваться сохраненные в кеше. Нужно передавать True, если тренировочные данные меняются(файлы отличаются от тех, которые были ранее для тренировки)
-        
-        input_query_dir - папка с аудио исходных спикеров(любой формат)
-        input_reffer_dir - папка с аудио целевых спикеров(любой формат)
-        temp_dir - временная директория для работы, в этой директории создаюся промежуточные файлы
-        output_dir - папка для выходных моделей
-        training_hyper_params - гиперпараметры тренировки, см. VOXNOTModelTrainingHyperParams
-        training_env - параметры окружения тренировки, см. VOXNOTModelTrainingEnvironment
-        training_name - название модели, так будет называться файл с посчитанными весами, который будет сохранен в output_dir
-        """
-
-        dataset_X = self._prepare_dataset(delete_last_prepared_data, input_query_dir, os.path.join(temp_dir, "input_ds_X"))
-        dataset_Y = self._prepare_dataset(delete_last_prepared_data, input_reffer_dir, os.path.join(temp_dir, "input_ds_Y"))
-
-        self.model_instance.set_train_params(training_hyper_params, training_env, dataset_X, dataset_Y, training_name)
-        self.model_instance.train()
-
-        model_path = self.model_instance.get_last_best_model_path()
-        model_dest_path = os.path.join(output_dir, f'{training_name}.pt')
-
-        print(f'Copy model {model_path} to {model_dest_path}')
-        shutil.copy2(model_path, model_dest_path)
-
-    def _get_files(self, path:str | os.PathLike):
-        file_list = []
-
-        if os.path.isdir(path) == True:
-            for file_path in os.listdir(path):
-              if os.path.isfile(os.path.join(path, file_path)) == True:
-                file_list.append(os.path.join(path, file_path))
-        else:
-            file_list.append(path)
-
-        return file_list
-
-
-    def make_conversation(self, query_path:str | os.PathLike, trained_model_path:str | os.PathLike, out_path:str | os.PathLike):
-        """
-        Метод конвертации речи по запросу в речь голосом целевого спикера
-        query_path - Папка или путь к файлу с аудио для конвертации
-        trained_model_path - Папка или путь к файлу с посчитанной моделью(весами), файлы которые появляются в результате работы метода "train"
-        out_path - Папка куда положить результат, wav файлы с результатом
-        """        
-        query_file_list = self._get_files(query_path)
-        model_file_list = self._get_files(trained_model_path)
-
-        helper = VOXNOTFeaturesHelper(self.device)
-
-        for model in model_file_list:
-            self.model_instance.load_weights(model)
-            model_name = os.path.basename(model)
-
-            for query_path in query_file_list:
-                X = helper.get_features([query_path, ])
-                Y = self.model_instance.predict(X)
-
-                out_file_path = out_path if os.path.isdir(out_path) == False else os.path.join(out_path, f"{os.path.basename(query_path)}_{model_name}.wav")
-
-                helper.vocode(Y, out_file_path)
-
+﻿# --------------------------------------------------------
+# VOXNOT(other name XNOT-VC): 
+# Github source: https://github.com/dmitrii-raketa-erusov/XNOT-VC
+# Copyright (c) 2024 Dmitrii Erusov
+# Licensed under The MIT License [see LICENSE for details]
+# Based on code bases
+# https://github.com/pytorch/
+# --------------------------------------------------------
+# Класс представляющий верхнеуровневое API для задач аудио-конверсии, 
+# а конкретно конверсии голоса в голос
+# на базе алгоритма XNOT(см. статью https://arxiv.org/pdf/2301.12874)
+
+# Предоставляет верхнеуровневые методы тренировки моделей с разными гипер-параметрами
+# и методы использования посчитанных моделей для конвертации речи из входной речи в речь на целевом голосе
+    
+# Основные методы для работы - 
+    
+# train
+# make_conversation
+# --------------------------------------------------------
+
+import contextlib
+import gc
+import os
+import shutil
+
+from concurrent.futures import ThreadPoolExecutor
+
+from sources.params import VOXNOTModelHyperParams, VOXNOTModelTrainingEnvironment, VOXNOTModelTrainingHyperParams
+
+# Тяжелые импорты(torch со стороны CUDA, модели, экстрактор features) делаются лениво
+# внутри методов, чтобы import этого модуля был дешевым для тех,
+# кто например только конвертирует небольшой запрос
+
+# Реестр известных классов моделей
+# явная таблица вместо поиска в globals(): опечатка в имени класса ловится сразу при создании,
+# а сами классы моделей импортируются лениво, при первом создании VOXNOT
+_MODEL_REGISTRY = None
+
+def _get_model_registry():
+    global _MODEL_REGISTRY
+
+    if _MODEL_REGISTRY == None:
+        from sources.MLPModel import VOXNOTMLPModel
+
+        _MODEL_REGISTRY = {
+            'VOXNOTMLPModel': VOXNOTMLPModel,
+        }
+
+    return _MODEL_REGISTRY
+
+class VOXNOT:
+    """
+    Класс представляющий верхнеуровневое API для задач аудио-конверсии, 
+    а конкретно конверсии голоса в голос
+    на базе алгоритма XNOT(см. статью https://arxiv.org/pdf/2301.12874)
+
+    Предоставляет верхнеуровневые методы тренировки моделей с разными гипер-параметрами
+    и методы использования посчитанных моделей для конвертации речи из входной речи в речь на целевом голосе
+    
+    Основные методы для работы - 
+    
+    train
+    make_conversation
+    """
+    model_instance:"VOXNOTBaseModel"
+
+    def __init__(self, device, model_class_name:str, hyper_params:VOXNOTModelHyperParams, prod_mode:bool):
+        """
+        model_class_name - Класс модели для конверсии
+        hyper_params - гипер-параметры модели
+        prod_mode - указывает как будет использоваться модель, для тренировки или конверсии. True - если для конверсии
+        """
+        self.device = device
+        self._features_cache = {}
+        self._features_helper = None
+        class_object = _get_model_registry()[model_class_name]
+        self.model_instance = class_object(device, hyper_params, prod_mode)
+
+    def _prepare_dataset(self, delete_last_prepared_data, input_dir, dataset_dir):
+        from torch.utils.data import ConcatDataset
+
+        from sources.data_preparation import VOXNOTDatasetPreparationTools
+        from sources.voxnot_dataset import VOXNOTDataset
+
+        exists_prepared_datasets = os.path.isdir(dataset_dir) and \
+            any(entry.is_file() and entry.name.endswith('.pt') for entry in os.scandir(dataset_dir))
+
+        if delete_last_prepared_data == True or exists_prepared_datasets == False:
+          print(f'Preparing datasets {input_dir}..')
+
+          shutil.rmtree(dataset_dir, ignore_errors = True)
+          os.makedirs(dataset_dir, exist_ok = True)
+
+          # Модели экстрактора(WavLM + HiFi GAN) - постоянные singleton'ы, грузим их
+          # до входа в transient-пул, иначе их веса выделятся внутри пула
+          # и навсегда закрепят его сегменты за собой
+          helper = self._get_features_helper()
+          helper.preload()
+
+          tool = VOXNOTDatasetPreparationTools(input_dir, dataset_dir, augmentation = None, keep_converted_audio = True, device = self.device, vad_trigger_level=0,
+                                               helper = helper)
+
+          with self._prep_mem_pool():
+              tool.prepare()
+
+        # Загружаем шарды параллельно, загрузка с диска - I/O-bound,
+        # последовательный цикл не использует глубину очереди диска
+        # Шарды материализуем на CPU, а не на self.device - так подготовка не конкурирует
+        # за память GPU со второй фазой, на устройство батчи переносит DataLoader во время тренировки
+        paths = [entry.path for entry in os.scandir(dataset_dir) if entry.is_file() and entry.name.endswith('.pt')]
+
+        datasets = []
+
+        if len(paths) > 0:
+            with ThreadPoolExecutor(max_workers = min(8, len(paths))) as executor:
+                datasets = list(executor.map(lambda path_file_ds: VOXNOTDataset(path_file_ds, 'cpu'), paths))
+
+        return ConcatDataset(datasets)
+
+    # Контекст выделения памяти для временных тензоров подготовки датасетов
+    # выделяем их в отдельном пуле аллокатора CUDA(PyTorch >= 2.5), чтобы на выходе
+    # сегменты пула отдавались обратно кеширующему аллокатору без обращений к драйверу,
+    # это быстрее, чем empty_cache между фазами подготовки
+    def _prep_mem_pool(self):
+        import torch
+
+        if torch.cuda.is_available() and hasattr(torch.cuda, 'use_mem_pool'):
+            return torch.cuda.use_mem_pool(torch.cuda.MemPool())
+
+        return contextlib.nullcontext()
+
+    @staticmethod
+    def clear_mem(collect_garbage:bool = False):
+        """
+        Метод для очистки мусора в памяти
+        лучше вызывать между тренировками или вычислениями
+        память на устройстве реально освобождает не empty_cache, а отпускание ссылок на тензоры,
+        поэтому сначала обнуляйте ссылки в вызывающем коде
+        collect_garbage - по умолчанию False, полный gc.collect() обходит весь граф объектов
+        и нужен только если тензоры удерживаются циклическими ссылками
+        """
+        import torch
+
+        if collect_garbage:
+            gc.collect()
+
+        # empty_cache не освобождает память тензоров, а только снижает фрагментацию,
+        # при этом каждый вызов синхронизирует устройство, поэтому вызываем не больше одного раза
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def train(self, delete_last_prepared_data:bool, input_query_dir:str | os.PathLike, input_reffer_dir:str | os.PathLike,
+              temp_dir:str | os.PathLike, output_dir:str | os.PathLike,
+              training_hyper_params:VOXNOTModelTrainingHyperParams, training_env:VOXNOTModelTrainingEnvironment,
+              training_name:str):
+        """
+        Метод тренировки модели
+        
+        delete_last_prepared_data - если True, то предыдущие тренировочные датасеты сделанные из audio-файлов будут удалены, если False, 
+        то будут использоваться сохраненные в кеше. Нужно передавать True, если тренировочные данные меняются(файлы отличаются от тех, которые были ранее для тренировки)
+        
+        input_query_dir - папка с аудио исходных спикеров(любой формат)
+        input_reffer_dir - папка с аудио целевых спикеров(любой формат)
+        temp_dir - временная директория для работы, в этой директории создаюся промежуточные файлы
+        output_dir - папка для выходных моделей
+        training_hyper_params - гиперпараметры тренировки, см. VOXNOTModelTrainingHyperParams
+        training_env - параметры окружения тренировки, см. VOXNOTModelTrainingEnvironment
+        training_name - название модели, так будет называться файл с посчитанными весами, который будет сохранен в output_dir
+        """
+
+        dataset_X = self._prepare_dataset(delete_last_prepared_data, input_query_dir, os.path.join(temp_dir, "input_ds_X"))
+        dataset_Y = self._prepare_dataset(delete_last_prepared_data, input_reffer_dir, os.path.join(temp_dir, "input_ds_Y"))
+
+        self.model_instance.set_train_params(training_hyper_params, training_env, dataset_X, dataset_Y, training_name)
+        self.model_instance.train()
+
+        # модель держит датасеты через data_loader_X/Y - отпускаем их на инстансе,
+        # иначе ссылки(и persistent worker'ы DataLoader'ов) переживут тренировку
+        # вместе с обнулением локальных ссылок это отдает память датасетов
+        # кеширующему аллокатору без обхода всего графа объектов через gc
+        self.model_instance.release_train_data()
+        dataset_X = None
+        dataset_Y = None
+
+        model_path = self.model_instance.get_last_best_model_path()
+        model_dest_path = os.path.join(output_dir, f'{training_name}.pt')
+
+        print(f'Copy model {model_path} to {model_dest_path}')
+        # copyfile вместо copy2 - метаданные(mtime, права) исходного checkpoint не нужны,
+        # а байты на Linux копируются внутри ядра через copy_file_range
+        shutil.copyfile(model_path, model_dest_path)
+
+    def _get_files(self, path:str | os.PathLike):
+        file_list = []
+
+        if os.path.isdir(path) == True:
+            file_list = [entry.path for entry in os.scandir(path) if entry.is_file()]
+        else:
+            file_list.append(path)
+
+        return file_list
+
+
+    # Единый экземпляр VOXNOTFeaturesHelper на инстанс
+    # helper лениво грузит большую SSL-модель(WavLM), создавать его заново
+    # на каждый вызов верхнеуровневого API незачем
+    def _get_features_helper(self):
+        if self._features_helper == None:
+            from sources.audio_helper import VOXNOTFeaturesHelper
+
+            self._features_helper = VOXNOTFeaturesHelper(self.device)
+
+        return self._features_helper
+
+    # Кеш audio-features по файлам запросов
+    # features зависят только от запроса, поэтому переиспользуем их между моделями
+    # и между повторными вызовами make_conversation, экстрактор(WavLM) сильно дороже поиска в кеше
+    # кеш живет на CPU - память GPU и так в дефиците после загрузки WavLM,
+    # на устройство батч переносится один раз при сборке в make_conversation
+    # запись на файл одна: (mtime, features), при изменении файла она перезаписывается,
+    # устаревшие features не накапливаются
+    def _get_query_features(self, helper, query_file):
+        mtime = os.path.getmtime(query_file)
+        cached = self._features_cache.get(query_file)
+
+        if cached == None or cached[0] != mtime:
+            cached = (mtime, helper.get_features([query_file, ]).to('cpu'))
+            self._features_cache[query_file] = cached
+
+        return cached[1]
+
+    def make_conversation(self, query_path:str | os.PathLike, trained_model_path:str | os.PathLike, out_path:str | os.PathLike):
+        """
+        Метод конвертации речи по запросу в речь голосом целевого спикера
+        query_path - Папка или путь к файлу с аудио для конвертации
+        trained_model_path - Папка или путь к файлу с посчитанной моделью(весами), файлы которые появляются в результате работы метода "train"
+        out_path - Папка куда положить результат, wav файлы с результатом
+        """
+        import torch
+
+        query_file_list = self._get_files(query_path)
+        model_file_list = self._get_files(trained_model_path)
+
+        # пустая папка с запросами: конвертировать нечего, torch.concat на пустом списке упадет
+        if len(query_file_list) == 0:
+            return
+
+        helper = self._get_features_helper()
+
+        # Извлекаем audio-features один раз для всех запросов, они зависят только от запроса, а не от модели
+        # Модель T работает покадрово, поэтому кадры всех запросов можно прогнать через predict одним батчом,
+        # а результат разрезать обратно по длинам запросов
+        # predict стартует только после сборки всего батча, поэтому выносить извлечение
+        # в фоновый поток нечем перекрывать - извлекаем простым циклом
+        X_list = [self._get_query_features(helper, query_file) for query_file in query_file_list]
+
+        lengths = [X.shape[0] for X in X_list]
+        X_batch = torch.concat(X_list, dim = 0)
+
+        # Конверсия на CUDA идет в FP16, модель T маленькая и на tensor cores
+        # это ~2x пропускной способности, заодно вдвое меньше данных на перенос
+        cuda_inference = torch.cuda.is_available() and torch.device(self.device).type == 'cuda'
+
+        if cuda_inference:
+            X_batch = X_batch.half()
+
+        # Батч собран из CPU-кеша, при конверсии на CUDA переносим его на устройство
+        # в отдельном CUDA stream - pin_memory делает копию действительно асинхронной,
+        # и она идет параллельно с загрузкой весов первой модели
+        # На CPU-конверсии CUDA контекст не трогаем вовсе
+        copy_stream = None
+
+        if cuda_inference and X_batch.device.type == 'cpu':
+            copy_stream = torch.cuda.Stream()
+
+            with torch.cuda.stream(copy_stream):
+                X_batch = X_batch.pin_memory().to(self.device, non_blocking = True)
+
+        # out_path не меняется по ходу конверсии, проверяем на директорию один раз,
+        # а не syscall на каждую пару (модель, запрос), имена запросов тоже считаем заранее
+        out_is_dir = os.path.isdir(out_path)
+        query_names = [os.path.basename(query_file) for query_file in query_file_list]
+
+        try:
+            # Вокодирование уходит в пул потоков: пока HiFi GAN и запись wav работают над
+            # результатами текущей модели, основной поток уже грузит веса и считает predict следующей
+            # выход из with - это shutdown(wait = True), все файлы записаны до возврата из метода
+            with ThreadPoolExecutor(max_workers = 2) as vocode_executor:
+                vocode_futures = []
+
+                for model in model_file_list:
+                    self.model_instance.load_weights(model)
+
+                    if cuda_inference:
+                        self.model_instance.half()
+
+                    model_name = os.path.basename(model)
+
+                    # перед первым predict дожидаемся окончания копирования батча на устройство
+                    # record_stream сообщает аллокатору, что блок X_batch(выделенный в copy_stream)
+                    # теперь читает основной stream - иначе блок могли бы переиспользовать раньше времени
+                    if copy_stream != None:
+                        torch.cuda.current_stream().wait_stream(copy_stream)
+                        X_batch.record_stream(torch.cuda.current_stream())
+                        copy_stream = None
+
+                    # inference_mode дешевле no_grad: без метаданных autograd и version counter на каждый тензор
+                    with torch.inference_mode():
+                        Y_batch = self.model_instance.predict(X_batch)
+
+                    # вокодер(HiFi GAN) работает в FP32
+                    if cuda_inference:
+                        Y_batch = Y_batch.float()
+
+                    # результат уводим на CPU одним переносом, чтобы потоки вокодера
+                    # не держали ссылки на батч на устройстве
+                    Y_batch = Y_batch.to('cpu', non_blocking = True)
+
+                    for query_name, Y in zip(query_names, torch.split(Y_batch, lengths, dim = 0)):
+                        if out_is_dir == False:
+                            # единый выходной файл: все пары (модель, запрос) пишут в один путь,
+                            # параллельные torchaudio.save перемешали бы его содержимое,
+                            # поэтому пишем последовательно - как раньше, последняя запись побеждает
+                            helper.vocode(Y, out_path)
+                        else:
+                            out_file_path = os.path.join(out_path, f"{query_name}_{model_name}.wav")
+                            vocode_futures.append(vocode_executor.submit(helper.vocode, Y, out_file_path))
+
+                # дожидаемся всех задач и перевызываем их исключения: shutdown(wait = True)
+                # только ждет, ошибки вокодера или записи файла без result() потерялись бы
+                for future in vocode_futures:
+                    future.result()
+
+        finally:
+            # возвращаем модель T в FP32 даже если конверсия упала: half() мутирует модель
+            # на инстансе, и следующий train() на не-prod инстансе столкнул бы FP16 T с FP32 F
+            if cuda_inference:
+                self.model_instance.float()
+
@@ -8,7 +8,6 @@
 # https://github.com/bshall/knn-vc/
 # --------------------------------------------------------
 
-import gc
 import torch
 from torch.functional import Tensor
 import torch
@@ -34,13 +33,19 @@ class VOXNOTFeaturesHelper:
 
         return VOXNOTFeaturesHelper._knn_vc
 
-    def get_features(self, files, vad_trigger_level = 0):
+    def preload(self):
         """
-        Extract features from audio with WalLM to TENSOR 
+        Force loading of the hub models (WavLM + HiFi GAN)
+        they are permanent singletons, so load them before entering any transient
+        memory pool - otherwise their weights would be allocated from that pool
+        and pin its segments forever
         """
-        gc.collect()
-        torch.cuda.empty_cache()
+        self._get_helper()
 
+    def get_features(self, files, vad_trigger_level = 0):
+        """
+        Extract features from audio with WalLM to TENSOR
+        """
         feats = []
         for path in files:
           feats.append(self._get_helper().get_features(path, weights = None, vad_trigger_level = vad_trigger_level))
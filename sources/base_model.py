@@ -92,6 +92,22 @@ class VOXNOTBaseModel:
         self.model_T.load_state_dict(torch.load(weights_path))
         self._freeze(self.model_T)
 
+    def half(self):
+        """
+        Перевести рабочую модель T в FP16
+        имеет смысл только для inference на CUDA: модель маленькая и на tensor cores
+        FP16 дает ~2x пропускную способность без заметной потери качества
+        после конверсии верните модель в FP32 через float(), иначе тренировка
+        столкнет FP16 T с FP32 F
+        """
+        self.model_T = self.model_T.half()
+
+    def float(self):
+        """
+        Вернуть рабочую модель T в FP32, парный метод к half()
+        """
+        self.model_T = self.model_T.float()
+
     def load_check_point(self, check_point_step:int, model_T_state:str | os.PathLike, model_F_state:str | os.PathLike, optim_T:str | os.PathLike, optim_F:str | os.PathLike):
         """
         Загрузить сохраненный checkpoint
@@ -180,14 +196,27 @@ class VOXNOTBaseModel:
         self.optim_F = torch.optim.Adam(self.model_F.parameters(), lr = self.training_hyper_params.LR, weight_decay = self.training_hyper_params.weight_decay)
 
     # инициализирует DataLoaders, переопределить, если хочется использовать свои
+    # датасеты приходят на CPU, поэтому включаем pin_memory и фоновые worker'ы,
+    # перенос батча на устройство делает LoaderSampler асинхронно
     def _init_data_loaders(self, dataset_X, dataset_Y):
         train_data_X, test_data_X = random_split(dataset_X, [1 - self.training_hyper_params.test_proportion, self.training_hyper_params.test_proportion])
         train_data_Y, test_data_Y = random_split(dataset_Y, [1 - self.training_hyper_params.test_proportion, self.training_hyper_params.test_proportion])
 
-        self.data_loader_X = LoaderSampler(DataLoader(train_data_X, shuffle = False, batch_size = self.training_hyper_params.batch_size), self.device)
-        self.data_loader_Y = LoaderSampler(DataLoader(train_data_Y, shuffle = False, batch_size = self.training_hyper_params.batch_size), self.device)
+        pin_memory = torch.cuda.is_available()
+
+        self.data_loader_X = LoaderSampler(DataLoader(train_data_X, shuffle = False, batch_size = self.training_hyper_params.batch_size,
+                                                      pin_memory = pin_memory, num_workers = 4, persistent_workers = True, prefetch_factor = 2), self.device)
+        self.data_loader_Y = LoaderSampler(DataLoader(train_data_Y, shuffle = False, batch_size = self.training_hyper_params.batch_size,
+                                                      pin_memory = pin_memory, num_workers = 4, persistent_workers = True, prefetch_factor = 2), self.device)
+
+    # отпускает ссылки на тренировочные данные после train()
+    # вместе с loader'ами завершаются их persistent worker'ы, а тензоры датасетов
+    # перестают удерживаться моделью
+    def release_train_data(self):
+        self.data_loader_X = None
+        self.data_loader_Y = None
 
-    # удаляет мусор            
+    # удаляет мусор
     def _free_mem(self):
         gc.collect()
         torch.cuda.empty_cache()
@@ -27,7 +27,8 @@ class VOXNOTDatasetPreparationTools:
     OUT_WAV_CHANNEL = 1 # Сколько каналов в выходном файле
     OUT_WAV_ENCODING = 'PCM_S' # Формат wav
 
-    def __init__(self, input_dir:str | os.PathLike, output_dir:str | os.PathLike, augmentation = None, keep_converted_audio:bool = False, device = None, vad_trigger_level = 0):
+    def __init__(self, input_dir:str | os.PathLike, output_dir:str | os.PathLike, augmentation = None, keep_converted_audio:bool = False, device = None, vad_trigger_level = 0,
+                 helper:VOXNOTFeaturesHelper = None):
         """
         inputDir - папка с исходными аудио-файлами
         outputDir - папка куда будут записываться датасеты с audio-features
@@ -41,14 +42,15 @@ class VOXNOTDatasetPreparationTools:
         ]
         augmentation_count - сколько случайных преобразований выполнять
         keepConvertedAudio - указывает нужно ли сохранять, полученные из исходного аудио, промежуточные аудио файлы, из которых вытягивались audio-features 
-        vad_trigger_level - уровень обрезки по громкости, по умолчанию 0, звуки любой громкости 
+        vad_trigger_level - уровень обрезки по громкости, по умолчанию 0, звуки любой громкости
+        helper - уже созданный VOXNOTFeaturesHelper, чтобы переиспользовать его между подготовкой и конверсией, если None - создается свой
         """
         self.input_dir = input_dir
         self.output_dir = output_dir
         self.augmentation = augmentation
         self.keep_converted_audio = keep_converted_audio
         self.device = device
-        self.helper = None
+        self.helper = helper
         self.vad_trigger_level = vad_trigger_level
     
     def prepare(self):
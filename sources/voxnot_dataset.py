@@ -48,7 +48,8 @@ class LoaderSampler(Sampler):
         if len(batch) < size:
             return self.sample(size)
 
-        return batch[:size].to(self.device)
+        # non_blocking вместе с pin_memory у DataLoader дает асинхронный перенос на устройство
+        return batch[:size].to(self.device, non_blocking = True)
 
 class VOXNOTDataset:
     """